@@ -8,77 +8,343 @@ from __future__ import annotations
 
 import argparse
 import hashlib
+import heapq
+import json
+import operator
+import os
 import re
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import accumulate
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 DEFAULT_EXCLUDE_DIRS = [".git", "target", "node_modules", "dist", "build"]
+# Bump whenever normalize_line changes so stale cache entries are ignored.
+CACHE_VERSION = 1
+
+# Polynomial rolling hash over interned line ids (Mersenne prime modulus).
+ROLL_BASE = 1000003
+ROLL_MOD = (1 << 61) - 1
+
+# Matches are packed into one int, (length, a_idx, a_start, b_idx, b_start)
+# from most to least significant, so int order equals tuple order.
+MATCH_FIELD_BITS = 32
+MATCH_FIELD_MASK = (1 << MATCH_FIELD_BITS) - 1
+
+WORD_CHAR = re.compile(r"[A-Za-z0-9_]")
+# Bytes where str and bytes disagree on line breaks or whitespace: ASCII
+# controls plus the UTF-8 encodings of non-ASCII whitespace characters.
+NON_BYTE_SAFE = re.compile(
+    rb"[\x0b\x0c\x1c-\x1f]"
+    rb"|\xc2[\x85\xa0]|\xe1\x9a\x80|\xe2\x80[\x80-\x8a\xa8\xa9\xaf]"
+    rb"|\xe2\x81\x9f|\xe3\x80\x80"
+)
+# Deletes every ASCII character that is not matched by WORD_CHAR.
+NON_WORD_ASCII = str.maketrans(
+    "", "", "".join(chr(c) for c in range(128) if not WORD_CHAR.match(chr(c)))
+)
 
 
 def normalize_line(line: str) -> str:
-    return re.sub(r"\s+", " ", line.strip())
+    # str.split() trims and collapses the same whitespace as re's \s+.
+    return " ".join(line.split())
 
 
 def is_significant(line: str) -> bool:
-    return bool(re.search(r"[A-Za-z0-9_]", line))
+    rest = line.translate(NON_WORD_ASCII)
+    if rest.isascii():
+        return bool(rest)
+    return WORD_CHAR.search(rest) is not None
+
 
+def iter_source_files(root: Path, exts: List[str], exclude_dirs: List[str]) -> Iterable[str]:
+    """Yield source file paths under `root` as strings.
 
-def iter_source_files(root: Path, exts: List[str], exclude_dirs: List[str]) -> Iterable[Path]:
+    Excluded directories are pruned before descending into them, and files
+    are matched on their name alone, so no per-entry stat is needed.
+    """
     exclude_set = set(exclude_dirs)
-    for path in root.rglob("*"):
-        if not path.is_file():
-            continue
-        if path.suffix.lstrip(".") not in exts:
-            continue
-        if exclude_set.intersection(path.parts):
-            continue
-        yield path
+    suffixes = tuple(f".{ext}" for ext in exts)
+
+    def walk(directory: str) -> Iterable[str]:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in exclude_set:
+                            yield from walk(entry.path)
+                    elif entry.name.endswith(suffixes) and entry.is_file():
+                        yield entry.path
+        except OSError:
+            return
+
+    yield from walk(str(root))
+
+
+def window_hashes(line_hashes: Sequence[int], min_lines: int) -> List[int]:
+    """Return the rolling hash of every `min_lines`-long window, by start line.
+
+    `line_hashes` must already be reduced modulo ROLL_MOD.
+    """
+    if len(line_hashes) < min_lines:
+        return []
+    base, mod = ROLL_BASE, ROLL_MOD
+    top_pow = pow(base, min_lines - 1, mod)
+    h = 0
+    for line_hash in line_hashes[:min_lines]:
+        h = (h * base + line_hash) % mod
+    hashes = [h]
+    append = hashes.append
+    # Each step drops the oldest line and appends the next one.
+    for out_hash, in_hash in zip(line_hashes, line_hashes[min_lines:]):
+        h = ((h - out_hash * top_pow) * base + in_hash) % mod
+        append(h)
+    return hashes
 
 
-def load_files(paths: Iterable[Path]) -> List[Tuple[Path, List[str]]]:
-    file_lines: List[Tuple[Path, List[str]]] = []
-    for path in paths:
+def eligible_starts(
+    sig_flags: bytearray, min_lines: int, min_significant: int
+) -> List[int]:
+    """Return window starts with at least `min_significant` significant lines."""
+    sig_prefix = [0, *accumulate(sig_flags)]
+    counts = map(operator.sub, sig_prefix[min_lines:], sig_prefix)
+    return [start for start, count in enumerate(counts) if count >= min_significant]
+
+
+def cache_entry_path(cache_dir: str, path: str) -> str:
+    digest = hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, digest[:2], f"{digest}.json")
+
+
+def load_cached_lines(entry: str, stat: os.stat_result) -> Optional[List[str]]:
+    try:
+        with open(entry, encoding="utf-8") as handle:
+            cached = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if (
+        not isinstance(cached, dict)
+        or cached.get("version") != CACHE_VERSION
+        or cached.get("mtime_ns") != stat.st_mtime_ns
+        or cached.get("size") != stat.st_size
+    ):
+        return None
+    lines = cached.get("lines")
+    if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        return None
+    return lines
+
+
+def store_cached_lines(entry: str, stat: os.stat_result, norms: List[str]) -> None:
+    payload = {
+        "version": CACHE_VERSION,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "lines": norms,
+    }
+    directory = os.path.dirname(entry)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
         try:
-            text = path.read_text(encoding="utf-8", errors="ignore")
-        except Exception:
-            continue
-        lines = text.splitlines()
-        norms = [normalize_line(line) for line in lines]
-        file_lines.append((path, norms))
+            with os.fdopen(fd, "w", encoding="utf-8") as handle:
+                json.dump(payload, handle)
+            os.replace(tmp_path, entry)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+
+
+def normalize_bytes(data: bytes) -> Optional[List[str]]:
+    """Normalize raw file bytes without decoding every line separately.
+
+    Lines are split and whitespace-collapsed as bytes and the result is
+    decoded once. Returns None when that would differ from normalizing the
+    decoded text (invalid UTF-8 or whitespace that only str recognizes).
+    """
+    if NON_BYTE_SAFE.search(data):
+        return None
+    lines = [b" ".join(line.split()) for line in data.splitlines()]
+    if not lines:
+        return []
+    try:
+        return b"\n".join(lines).decode("utf-8").split("\n")
+    except UnicodeDecodeError:
+        return None
+
+
+def read_normalized(path: str, cache_dir: Optional[str] = None) -> Optional[List[str]]:
+    """Return the normalized lines of `path`, or None if it cannot be read.
+
+    With a `cache_dir`, files whose mtime and size match their cache entry
+    are not read at all; other files refresh their entry after reading.
+    Entries are keyed on the path and validated by stat rather than by a
+    content hash: a warm hit then costs one stat instead of a full read,
+    at the price of missing edits that keep both mtime and size unchanged.
+    """
+    entry = None
+    if cache_dir is not None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        entry = cache_entry_path(cache_dir, path)
+        cached = load_cached_lines(entry, stat)
+        if cached is not None:
+            return cached
+    try:
+        with open(path, "rb") as handle:
+            data = handle.read()
+    except Exception:
+        return None
+    norms = normalize_bytes(data)
+    if norms is None:
+        text = data.decode("utf-8", errors="ignore")
+        norms = [normalize_line(line) for line in text.splitlines()]
+    if entry is not None:
+        store_cached_lines(entry, stat, norms)
+    return norms
+
+
+def load_files(
+    paths: Iterable[str],
+    line_ids: Dict[str, int],
+    cache_dir: Optional[str] = None,
+) -> List[Tuple[str, array]]:
+    """Load files as arrays of normalized line ids.
+
+    Files are read and normalized on a thread pool; each distinct
+    normalized line is then interned into `line_ids` once, in path order,
+    so later comparisons between lines are plain integer comparisons.
+    """
+    paths = list(paths)
+    file_lines: List[Tuple[str, array]] = []
+    intern = line_ids.setdefault
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    read = partial(read_normalized, cache_dir=cache_dir)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, norms in zip(paths, executor.map(read, paths)):
+            if norms is None:
+                continue
+            ids = array("i", [intern(line, len(line_ids)) for line in norms])
+            file_lines.append((path, ids))
     return file_lines
 
 
+def shared_windows(
+    hashes: array, files: array, starts: array
+) -> Iterable[List[Tuple[int, int]]]:
+    """Yield the (file_idx, start) occurrences of every hash seen twice or more.
+
+    Windows are grouped by sorting their indices on hash and scanning for
+    runs, so hashes that occur only once never allocate a bucket. The sort
+    is stable, keeping occurrences in their original order.
+    """
+    order = sorted(range(len(hashes)), key=hashes.__getitem__)
+    total = len(order)
+    run_start = 0
+    while run_start < total:
+        run_hash = hashes[order[run_start]]
+        run_end = run_start + 1
+        while run_end < total and hashes[order[run_end]] == run_hash:
+            run_end += 1
+        if run_end - run_start >= 2:
+            yield [(files[idx], starts[idx]) for idx in order[run_start:run_end]]
+        run_start = run_end
+
+
+def run_before(a_lines: array, a_pos: int, b_lines: array, b_pos: int) -> int:
+    """Count the equal lines immediately before `a_pos` and `b_pos`."""
+    count = 0
+    while (
+        count < a_pos
+        and count < b_pos
+        and a_lines[a_pos - count - 1] == b_lines[b_pos - count - 1]
+    ):
+        count += 1
+    return count
+
+
+def run_after(a_lines: array, a_pos: int, b_lines: array, b_pos: int) -> int:
+    """Count the equal lines starting at `a_pos` and `b_pos`."""
+    count = 0
+    while (
+        a_pos + count < len(a_lines)
+        and b_pos + count < len(b_lines)
+        and a_lines[a_pos + count] == b_lines[b_pos + count]
+    ):
+        count += 1
+    return count
+
+
 def find_duplicates(
-    file_lines: List[Tuple[Path, List[str]]],
+    file_lines: List[Tuple[str, array]],
+    line_ids: Dict[str, int],
     min_lines: int,
     min_significant: int,
     max_pairs_per_hash: int,
     include_same_file: bool,
-) -> List[Tuple[int, int, int, int, int]]:
-    windows = {}
-    for file_idx, (_, norms) in enumerate(file_lines):
-        total = len(norms)
-        if total < min_lines:
+) -> List[int]:
+    """Return packed duplicate matches, unordered; see top_matches."""
+    # line_ids preserves insertion order, so position i describes id i.
+    sig_by_id = bytearray(is_significant(line) for line in line_ids)
+    window_hash = array("Q")
+    window_file = array("i")
+    window_start = array("i")
+    for file_idx, (_, ids) in enumerate(file_lines):
+        if len(ids) < min_lines:
             continue
-        sig_flags = [1 if is_significant(line) else 0 for line in norms]
-        sig_prefix = [0]
-        for flag in sig_flags:
-            sig_prefix.append(sig_prefix[-1] + flag)
-        for start in range(0, total - min_lines + 1):
-            sig_count = sig_prefix[start + min_lines] - sig_prefix[start]
-            if sig_count < min_significant:
-                continue
-            window = "\n".join(norms[start : start + min_lines])
-            digest = hashlib.sha1(window.encode("utf-8")).hexdigest()
-            windows.setdefault(digest, []).append((file_idx, start))
-
-    matches: List[Tuple[int, int, int, int, int]] = []
-    seen = set()
-    for occs in windows.values():
-        if len(occs) < 2:
+        sig_flags = bytearray(map(sig_by_id.__getitem__, ids))
+        starts = eligible_starts(sig_flags, min_lines, min_significant)
+        if not starts:
             continue
+        hashes = window_hashes(ids, min_lines)
+        window_hash.extend(map(hashes.__getitem__, starts))
+        window_file.extend([file_idx] * len(starts))
+        window_start.extend(starts)
+
+    matches: List[int] = []
+    seen: Set[int] = set()
+    # Maximal runs already extended, per (a_idx, b_idx, a_start - b_start)
+    # diagonal, as sorted (starts, ends) lists; runs on one diagonal never
+    # overlap. Any window inside a known run extends to that same run.
+    extended: Dict[Tuple[int, int, int], Tuple[List[int], List[int]]] = {}
+    for occs in shared_windows(window_hash, window_file, window_start):
         if len(occs) > max_pairs_per_hash:
             occs = occs[:max_pairs_per_hash]
+        # Extension lengths of each occurrence against occs[0], filled in on
+        # first use. Two occurrences agree for the shorter of their runs; only
+        # when both runs are equal can the pair extend further. The reference
+        # is only bounded by its own file, so it needs no walk. Occurrences
+        # whose window merely collides with the reference's map to None.
+        ref_idx, ref_start = occs[0]
+        _, ref_lines = file_lines[ref_idx]
+        ref_window = ref_lines[ref_start : ref_start + min_lines]
+        ref_runs: Dict[int, Optional[Tuple[int, int]]] = {
+            0: (ref_start, len(ref_lines) - ref_start - min_lines)
+        }
+
+        def reference_run(k: int) -> Optional[Tuple[int, int]]:
+            if k not in ref_runs:
+                idx, start = occs[k]
+                _, lines = file_lines[idx]
+                if lines[start : start + min_lines] != ref_window:
+                    ref_runs[k] = None
+                else:
+                    ref_runs[k] = (
+                        run_before(lines, start, ref_lines, ref_start),
+                        run_after(
+                            lines, start + min_lines, ref_lines, ref_start + min_lines
+                        ),
+                    )
+            return ref_runs[k]
+
         for i in range(len(occs)):
             for j in range(i + 1, len(occs)):
                 a_idx, a_start = occs[i]
@@ -87,35 +353,73 @@ def find_duplicates(
                     continue
                 if a_idx == b_idx and abs(a_start - b_start) < min_lines:
                     continue
+                diagonal = (a_idx, b_idx, a_start - b_start)
+                runs = extended.get(diagonal)
+                if runs is not None:
+                    run_starts, run_ends = runs
+                    pos = bisect_right(run_starts, a_start) - 1
+                    if pos >= 0 and a_start + min_lines <= run_ends[pos]:
+                        continue
                 _, a_lines = file_lines[a_idx]
                 _, b_lines = file_lines[b_idx]
-                start_a, start_b = a_start, b_start
-                while (
-                    start_a > 0
-                    and start_b > 0
-                    and a_lines[start_a - 1] == b_lines[start_b - 1]
-                ):
-                    start_a -= 1
-                    start_b -= 1
-                end_a = a_start + min_lines
-                end_b = b_start + min_lines
-                while (
-                    end_a < len(a_lines)
-                    and end_b < len(b_lines)
-                    and a_lines[end_a] == b_lines[end_b]
+                # Rolling hashes can collide; confirm the windows really match.
+                if (
+                    a_lines[a_start : a_start + min_lines]
+                    != b_lines[b_start : b_start + min_lines]
                 ):
-                    end_a += 1
-                    end_b += 1
-                length = end_a - start_a
-                key = (a_idx, start_a, b_idx, start_b, length)
-                if key in seen:
                     continue
-                seen.add(key)
-                matches.append((length, a_idx, start_a, b_idx, start_b))
-    matches.sort(reverse=True)
+                run_i = reference_run(i)
+                run_j = reference_run(j)
+                if run_i is None or run_j is None:
+                    left = run_before(a_lines, a_start, b_lines, b_start)
+                    right = run_after(
+                        a_lines, a_start + min_lines, b_lines, b_start + min_lines
+                    )
+                else:
+                    (left_i, right_i), (left_j, right_j) = run_i, run_j
+                    left = min(left_i, left_j)
+                    if left_i == left_j:
+                        left += run_before(
+                            a_lines, a_start - left, b_lines, b_start - left
+                        )
+                    right = min(right_i, right_j)
+                    if right_i == right_j:
+                        end = min_lines + right
+                        right += run_after(
+                            a_lines, a_start + end, b_lines, b_start + end
+                        )
+                start_a, start_b = a_start - left, b_start - left
+                end_a = a_start + min_lines + right
+                if runs is None:
+                    runs = extended[diagonal] = ([], [])
+                run_starts, run_ends = runs
+                pos = bisect_left(run_starts, start_a)
+                run_starts.insert(pos, start_a)
+                run_ends.insert(pos, end_a)
+                # The packed match doubles as its deduplication key.
+                packed = end_a - start_a
+                for field in (a_idx, start_a, b_idx, start_b):
+                    packed = (packed << MATCH_FIELD_BITS) | field
+                if packed in seen:
+                    continue
+                seen.add(packed)
+                matches.append(packed)
     return matches
 
 
+def top_matches(matches: List[int], top: int) -> List[Tuple[int, int, int, int, int]]:
+    """Unpack the `top` largest matches, longest first."""
+    result = []
+    for packed in heapq.nlargest(top, matches):
+        fields = []
+        for _ in range(5):
+            fields.append(packed & MATCH_FIELD_MASK)
+            packed >>= MATCH_FIELD_BITS
+        length, a_idx, a_start, b_idx, b_start = reversed(fields)
+        result.append((length, a_idx, a_start, b_idx, b_start))
+    return result
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Find duplicate code blocks.")
     parser.add_argument(
@@ -164,17 +468,28 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Exclude duplicates within the same file.",
     )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Cache normalized files in this directory across runs (default: off).",
+    )
     return parser.parse_args()
 
 
 def main() -> int:
     args = parse_args()
     root = Path(args.root)
-    files = list(iter_source_files(root, args.ext, args.exclude_dir))
-    files.sort()
-    file_lines = load_files(files)
+    # Order by path components, matching how Path objects compare.
+    files = sorted(
+        iter_source_files(root, args.ext, args.exclude_dir),
+        key=lambda path: path.split(os.sep),
+    )
+    line_ids: Dict[str, int] = {}
+    cache_dir = os.path.expanduser(args.cache_dir) if args.cache_dir else None
+    file_lines = load_files(files, line_ids, cache_dir)
     matches = find_duplicates(
         file_lines,
+        line_ids,
         min_lines=args.min_lines,
         min_significant=args.min_significant,
         max_pairs_per_hash=args.max_pairs_per_hash,
@@ -187,9 +502,9 @@ def main() -> int:
     if not matches:
         return 0
     print("Top duplicates:")
-    for length, a_idx, a_start, b_idx, b_start in matches[: args.top]:
-        a_path = file_lines[a_idx][0].relative_to(root)
-        b_path = file_lines[b_idx][0].relative_to(root)
+    for length, a_idx, a_start, b_idx, b_start in top_matches(matches, args.top):
+        a_path = Path(file_lines[a_idx][0]).relative_to(root)
+        b_path = Path(file_lines[b_idx][0]).relative_to(root)
         print(
             f"- {length} lines: {a_path}:{a_start + 1} <-> {b_path}:{b_start + 1}"
         )
@@ -4,74 +4,133 @@ from __future__ import annotations
 import pathlib
 import re
 import sys
+from typing import Callable
 
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]
 
+WORKSPACE_PACKAGE_HEADER = "[workspace.package]"
+SECTION_VERSION_PATTERN = re.compile(r'^\s*version\s*=\s*"([^"]+)"', re.MULTILINE)
+JSON_VERSION_PATTERN = re.compile(r'("version"\s*:\s*")([^"]+)(")')
+TOML_VERSION_PATTERN = re.compile(r'^(version\s*=\s*")([^"]+)(")$', re.MULTILINE)
+DOC_VERSION_PATTERN = re.compile(r'("version"\s*:\s*")(\d+\.\d+\.\d+)(")')
+
+Edit = Callable[[str], tuple[str, int]]
+
+
+def find_workspace_package_section(text: str) -> str | None:
+  """Return the body of the `[workspace.package]` table, or None."""
+  start = 0
+  while True:
+    header = text.find(WORKSPACE_PACKAGE_HEADER, start)
+    if header < 0:
+      return None
+    line_end = text.find("\n", header)
+    line_end = len(text) if line_end < 0 else line_end
+    at_line_start = header == 0 or text[header - 1] == "\n"
+    rest_of_line = text[header + len(WORKSPACE_PACKAGE_HEADER):line_end]
+    if at_line_start and not rest_of_line.strip():
+      break
+    start = line_end
+  next_section = text.find("\n[", line_end)
+  return text[line_end:] if next_section < 0 else text[line_end:next_section + 1]
+
+
+def skip_whitespace(text: str, pos: int) -> int:
+  while pos < len(text) and text[pos].isspace():
+    pos += 1
+  return pos
+
+
+def find_package_lock_root(text: str) -> int:
+  """Return the offset of the `"packages": {"": {` root entry, or -1."""
+  start = 0
+  while True:
+    packages = text.find('"packages"', start)
+    if packages < 0:
+      return -1
+    start = packages + len('"packages"')
+    pos = start
+    root = -1
+    for token in (":", "{", '""', ":", "{"):
+      pos = skip_whitespace(text, pos)
+      if not text.startswith(token, pos):
+        break
+      if token == '""':
+        root = pos
+      pos += len(token)
+    else:
+      return root
+
 
 def load_workspace_version() -> str:
   cargo_toml = ROOT / "Cargo.toml"
   text = cargo_toml.read_text()
-  section_match = re.search(
-    r'^\[workspace\.package\]\s*$([\s\S]*?)(?:^\[|\Z)',
-    text,
-    re.MULTILINE,
-  )
-  if not section_match:
+  section = find_workspace_package_section(text)
+  if section is None:
     raise RuntimeError("Missing [workspace.package] section in Cargo.toml")
-  section = section_match.group(1)
-  version_match = re.search(r'^\s*version\s*=\s*"([^"]+)"', section, re.MULTILINE)
+  version_match = SECTION_VERSION_PATTERN.search(section)
   if not version_match:
     raise RuntimeError("Missing [workspace.package].version in Cargo.toml")
   return version_match.group(1)
 
 
-def replace_pattern(path: pathlib.Path, pattern: re.Pattern[str], replacement: str, count: int = 1) -> None:
-  text = path.read_text()
-  updated, changed = pattern.subn(replacement, text, count=count)
-  if changed == 0:
-    raise RuntimeError(f"Pattern not found in {path}")
-  path.write_text(updated)
+def pattern_edit(pattern: re.Pattern[str], replacement: str, count: int = 1) -> Edit:
+  return lambda text: pattern.subn(replacement, text, count=count)
+
+
+def package_lock_root_edit(replacement: str) -> Edit:
+  def edit(text: str) -> tuple[str, int]:
+    root = find_package_lock_root(text)
+    if root < 0:
+      return text, 0
+    tail, changed = JSON_VERSION_PATTERN.subn(replacement, text[root:], count=1)
+    return text[:root] + tail, changed
+
+  return edit
 
-def maybe_replace_pattern(path: pathlib.Path, pattern: re.Pattern[str], replacement: str, count: int = 1) -> None:
-  if not path.exists():
+
+def rewrite(path: pathlib.Path, edits: list[Edit], missing_ok: bool = False) -> None:
+  """Apply every edit to `path` with a single read and at most one write."""
+  if missing_ok and not path.exists():
     return
-  replace_pattern(path, pattern, replacement, count=count)
+  text = path.read_text()
+  updated = text
+  for edit in edits:
+    updated, changed = edit(updated)
+    if changed == 0:
+      raise RuntimeError(f"Pattern not found in {path}")
+  if updated != text:
+    path.write_text(updated)
 
 
 def main() -> int:
   version = load_workspace_version()
+  replacement = rf'\g<1>{version}\g<3>'
 
-  replace_pattern(
+  rewrite(
     ROOT / "console-ui/package.json",
-    re.compile(r'("version"\s*:\s*")([^"]+)(")'),
-    rf'\g<1>{version}\g<3>',
+    [pattern_edit(JSON_VERSION_PATTERN, replacement)],
   )
-  replace_pattern(
+  rewrite(
     ROOT / "console-ui/src-tauri/tauri.conf.json",
-    re.compile(r'("version"\s*:\s*")([^"]+)(")'),
-    rf'\g<1>{version}\g<3>',
+    [pattern_edit(JSON_VERSION_PATTERN, replacement)],
   )
-  replace_pattern(
+  rewrite(
     ROOT / "console-ui/src-tauri/Cargo.toml",
-    re.compile(r'^(version\s*=\s*")([^"]+)(")$', re.MULTILINE),
-    rf'\g<1>{version}\g<3>',
-  )
-  replace_pattern(
-    ROOT / "console-ui/package-lock.json",
-    re.compile(r'("version"\s*:\s*")([^"]+)(")'),
-    rf'\g<1>{version}\g<3>',
+    [pattern_edit(TOML_VERSION_PATTERN, replacement)],
   )
-  replace_pattern(
+  rewrite(
     ROOT / "console-ui/package-lock.json",
-    re.compile(r'("packages"\s*:\s*\{\s*""\s*:\s*\{[\s\S]*?"version"\s*:\s*")([^"]+)(")', re.MULTILINE),
-    rf'\g<1>{version}\g<3>',
+    [
+      pattern_edit(JSON_VERSION_PATTERN, replacement),
+      package_lock_root_edit(replacement),
+    ],
   )
-  maybe_replace_pattern(
+  rewrite(
     ROOT / "docs/acp-client-integration.md",
-    re.compile(r'("version"\s*:\s*")(\d+\.\d+\.\d+)(")'),
-    rf'\g<1>{version}\g<3>',
-    count=0,
+    [pattern_edit(DOC_VERSION_PATTERN, replacement, count=0)],
+    missing_ok=True,
   )
 
   return 0